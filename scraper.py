@@ -1,10 +1,14 @@
 import os
-import json
 import re
-from typing import List, Dict, Optional, Set
+import sqlite3
+import time
+from typing import Iterable, List, Dict, Optional, Set, Tuple
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import logging
 
 # --- Configuration ---
@@ -12,8 +16,22 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Using a session with comprehensive headers
-session = requests.Session()
+# Using a session with comprehensive headers.
+# For development, set SCRAPER_CACHE_EXPIRE to a number of seconds to replay
+# the scraped pages from a local cache instead of hitting the sites on every
+# run. Only the scrapes are replayed: the run still records listings in
+# sent_listings.db and posts to DISCORD_WEBHOOK_URL, so point both at
+# throwaway targets while developing.
+if os.getenv("SCRAPER_CACHE_EXPIRE"):
+    import requests_cache  # dev-only: pip install requests-cache
+
+    session = requests_cache.CachedSession(
+        "scraper_cache",
+        backend="sqlite",
+        expire_after=int(os.environ["SCRAPER_CACHE_EXPIRE"]),
+    )
+else:
+    session = requests.Session()
 session.headers.update(
     {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -25,12 +43,35 @@ session.headers.update(
         "Cache-Control": "max-age=0",
     }
 )
-
-SENT_LISTINGS_FILE = "sent_listings.json"
+if os.getenv("SCRAPER_CACHE_EXPIRE"):
+    # requests-cache honours max-age=0 as "always revalidate", which would
+    # bypass the cache on every request.
+    del session.headers["Cache-Control"]
+
+# Discord webhook posts all go to one host, so keep them on a single
+# persistent HTTP/2 connection.
+discord_client = httpx.Client(http2=True, timeout=10.0)
+
+# ETag / Last-Modified validators from the last response for each search URL.
+validators: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
+SENT_LISTINGS_DB = "sent_listings.db"
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_RETRIES = 3
+# Longest rate-limit wait worth sitting out; beyond this the batch is left for
+# the next scheduled run instead of stalling this one.
+DISCORD_MAX_RETRY_DELAY = 30
+
+# Rightmove and Zoopla embed their results as JSON in the Next.js data script,
+# so we slice it straight out of the raw bytes instead of building a DOM.
+_NEXT_DATA_RE = re.compile(
+    rb'<script[^>]*id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL
+)
+_FEATURES_RE = re.compile(r"(\d+)\s*bed|(\d+)\s*bath", re.IGNORECASE)
 
 
 # --- Data Structure ---
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Property:
     name: str
     link: str
@@ -43,6 +84,66 @@ class Property:
 
 # --- Scraping Functions ---
 
+def _dig(obj, *keys, default=None):
+    """
+    Subscripts straight down a nested JSON value, returning default if any
+    key or index along the path is missing.
+    """
+    try:
+        for key in keys:
+            obj = obj[key]
+    except (KeyError, IndexError, TypeError):
+        return default
+    return obj
+
+
+def conditional_get(url: str) -> Optional[requests.Response]:
+    """
+    GETs a URL, revalidating against the ETag / Last-Modified seen last time.
+    Returns None when the server answers 304 Not Modified.
+    """
+    etag, last_modified = validators.get(url, (None, None))
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    # All three sites serve UTF-8. The parsers read response.content, but pin
+    # the encoding anyway so response.text can never fall back to sniffing it.
+    response.encoding = "utf-8"
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        validators[url] = (etag, last_modified)
+    else:
+        validators.pop(url, None)
+    return response
+
+
+def parse_rightmove_listing(listing: Dict) -> Optional[Property]:
+    try:
+        return Property(
+            name=listing.get("displayAddress", "N/A"),
+            link=f"https://www.rightmove.co.uk{listing.get('propertyUrl', '')}",
+            image=_dig(listing, "propertyImages", "mainImageSrc", default=""),
+            price=_dig(
+                listing, "price", "displayPrices", 0, "displayPrice", default="N/A"
+            ),
+            bedrooms=listing.get("bedrooms", 0),
+            bathrooms=listing.get("bathrooms", 0),
+            source="Rightmove",
+        )
+    except (AttributeError, KeyError, IndexError) as e:
+        logging.warning(f"Skipping a Rightmove listing due to parsing error: {e}")
+        return None
+
+
 def scrape_rightmove(url: str) -> List[Property]:
     """
     Scrapes property listings from a Rightmove URL.
@@ -51,55 +152,48 @@ def scrape_rightmove(url: str) -> List[Property]:
     logging.info("Scraping Rightmove...")
     properties = []
     try:
-        response = session.get(url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = conditional_get(url)
+        if response is None:
+            logging.info("Rightmove results unchanged since the last run.")
+            return []
 
-        script = soup.find("script", {"id": "__NEXT_DATA__"})
-        if not script:
+        match = _NEXT_DATA_RE.search(response.content)
+        if not match:
             logging.warning("Could not find __NEXT_DATA__ script on Rightmove.")
             return []
 
-        data = json.loads(script.string)
+        data = orjson.loads(match.group(1))
         # UPDATED: The path to properties is inside 'results'.
-        listings = (
-            data.get("props", {})
-            .get("pageProps", {})
-            .get("results", {})
-            .get("properties", [])
-        )
+        listings = _dig(data, "props", "pageProps", "results", "properties")
 
         if not listings:
             logging.info("No listings found on Rightmove for this search.")
             return []
 
-        for listing in listings:
-            try:
-                prop = Property(
-                    name=listing.get("displayAddress", "N/A"),
-                    link=f"https://www.rightmove.co.uk{listing.get('propertyUrl', '')}",
-                    image=listing.get("propertyImages", {}).get(
-                        "mainImageSrc", ""
-                    ),
-                    price=listing.get("price", {}).get("displayPrices", [{}])[
-                        0
-                    ].get("displayPrice", "N/A"),
-                    bedrooms=listing.get("bedrooms", 0),
-                    bathrooms=listing.get("bathrooms", 0),
-                    source="Rightmove",
-                )
-                properties.append(prop)
-            except (KeyError, IndexError) as e:
-                logging.warning(
-                    f"Skipping a Rightmove listing due to parsing error: {e}"
-                )
-                continue
+        parsed = [parse_rightmove_listing(listing) for listing in listings]
+        properties = [prop for prop in parsed if prop is not None]
 
     except requests.RequestException as e:
         logging.error(f"Error scraping Rightmove: {e}")
     return properties
 
 
+def parse_zoopla_listing(listing: Dict) -> Optional[Property]:
+    try:
+        return Property(
+            name=listing.get("title", "N/A"),
+            link=f"https://www.zoopla.co.uk{_dig(listing, 'listingUris', 'detail', default='')}",
+            image=_dig(listing, "image", "url", default=""),
+            price=_dig(listing, "pricing", "label", default="N/A"),
+            bedrooms=listing.get("beds", 0),
+            bathrooms=listing.get("baths", 0),
+            source="Zoopla",
+        )
+    except (AttributeError, KeyError, IndexError) as e:
+        logging.warning(f"Skipping a Zoopla listing due to parsing error: {e}")
+        return None
+
+
 def scrape_zoopla(url: str) -> List[Property]:
     """
     Scrapes property listings from a Zoopla URL.
@@ -114,42 +208,25 @@ def scrape_zoopla(url: str) -> List[Property]:
 
         # Now, make the request to the actual search URL.
         logging.info("Fetching Zoopla search results...")
-        response = session.get(url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = conditional_get(url)
+        if response is None:
+            logging.info("Zoopla results unchanged since the last run.")
+            return []
 
-        script = soup.find("script", {"id": "__NEXT_DATA__"})
-        if not script:
+        match = _NEXT_DATA_RE.search(response.content)
+        if not match:
             logging.warning("Could not find __NEXT_DATA__ script on Zoopla.")
             return []
 
-        data = json.loads(script.string)
-        listings = (
-            data.get("props", {})
-            .get("pageProps", {})
-            .get("regularListings", {})
-            .get("listings", [])
-        )
+        data = orjson.loads(match.group(1))
+        listings = _dig(data, "props", "pageProps", "regularListings", "listings")
 
         if not listings:
             logging.info("No listings found on Zoopla for this search.")
             return []
 
-        for listing in listings:
-            try:
-                prop = Property(
-                    name=listing.get("title", "N/A"),
-                    link=f"https://www.zoopla.co.uk{listing.get('listingUris', {}).get('detail', '')}",
-                    image=listing.get("image", {}).get("url", ""),
-                    price=listing.get("pricing", {}).get("label", "N/A"),
-                    bedrooms=listing.get("beds", 0),
-                    bathrooms=listing.get("baths", 0),
-                    source="Zoopla",
-                )
-                properties.append(prop)
-            except (KeyError, IndexError) as e:
-                logging.warning(f"Skipping a Zoopla listing due to parsing error: {e}")
-                continue
+        parsed = [parse_zoopla_listing(listing) for listing in listings]
+        properties = [prop for prop in parsed if prop is not None]
 
     except requests.RequestException as e:
         logging.error(f"Error scraping Zoopla: {e}")
@@ -164,51 +241,52 @@ def scrape_onthemarket(url: str) -> List[Property]:
     logging.info("Scraping OnTheMarket...")
     properties = []
     try:
-        response = session.get(url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = conditional_get(url)
+        if response is None:
+            logging.info("OnTheMarket results unchanged since the last run.")
+            return []
+        tree = LexborHTMLParser(response.content)
 
         # UPDATED: More robust checking.
         # First, check if the page is a "no results" page.
-        no_results_header = soup.find(
-            "h1", string=re.compile(r"Sorry, no properties found")
-        )
-        if no_results_header:
-            logging.info(
-                "OnTheMarket returned a 'no results' page, which is expected."
-            )
-            return []
+        for header in tree.css("h1"):
+            if "Sorry, no properties found" in header.text():
+                logging.info(
+                    "OnTheMarket returned a 'no results' page, which is expected."
+                )
+                return []
 
         # If not, look for the main container.
-        property_list_container = soup.select_one("#properties-list-tab-panel")
+        property_list_container = tree.css_first("#properties-list-tab-panel")
         if not property_list_container:
             logging.warning(
                 "OnTheMarket page structure may have changed; neither results nor 'no results' message found."
             )
             return []
 
-        for card in property_list_container.select("li.otm-PropertyCard"):
+        for card in property_list_container.css("li.otm-PropertyCard"):
             try:
-                name_tag = card.select_one("span.otm-PropertyCard-address")
-                price_tag = card.select_one("div.otm-PropertyCard-price")
-                link_tag = card.select_one("a.otm-PropertyCard-link")
-                img_tag = card.select_one("img.otm-PropertyCard-image")
+                name_tag = card.css_first("span.otm-PropertyCard-address")
+                price_tag = card.css_first("div.otm-PropertyCard-price")
+                link_tag = card.css_first("a.otm-PropertyCard-link")
+                img_tag = card.css_first("img.otm-PropertyCard-image")
 
-                features = card.select("div.otm-PropertyCard-features span")
+                features = card.css_first("div.otm-PropertyCard-features")
                 beds, baths = 0, 0
-                for feature in features:
-                    text = feature.get_text(strip=True).lower()
-                    if "bed" in text:
-                        beds = int(re.search(r"\d+", text).group())
-                    if "bath" in text:
-                        baths = int(re.search(r"\d+", text).group())
+                if features:
+                    text = features.text(separator=" ")
+                    for match in _FEATURES_RE.finditer(text):
+                        if match.group(1):
+                            beds = int(match.group(1))
+                        else:
+                            baths = int(match.group(2))
 
                 if name_tag and price_tag and link_tag:
                     prop = Property(
-                        name=name_tag.get_text(strip=True),
-                        link=f"https://www.onthemarket.com{link_tag['href']}",
-                        image=img_tag["src"] if img_tag else "",
-                        price=price_tag.get_text(strip=True),
+                        name=name_tag.text(strip=True),
+                        link=f"https://www.onthemarket.com{link_tag.attributes['href']}",
+                        image=(img_tag.attributes.get("src") or "") if img_tag else "",
+                        price=price_tag.text(strip=True),
                         bedrooms=beds,
                         bathrooms=baths,
                         source="OnTheMarket",
@@ -225,26 +303,67 @@ def scrape_onthemarket(url: str) -> List[Property]:
     return properties
 
 
-# --- State Management & Notification (No changes needed below this line) ---
+# --- State Management & Notification ---
 
 
-def load_sent_listings() -> Set[str]:
-    try:
-        with open(SENT_LISTINGS_FILE, "r") as f:
-            content = f.read()
-            if not content:
-                return set()
-            return set(json.loads(content))
-    except (FileNotFoundError, json.JSONDecodeError):
+def open_state_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(SENT_LISTINGS_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS sent (link TEXT PRIMARY KEY)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS validators"
+        " (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)"
+    )
+    return conn
+
+
+def load_validators(
+    conn: sqlite3.Connection,
+) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    rows = conn.execute("SELECT url, etag, last_modified FROM validators")
+    return {url: (etag, last_modified) for url, etag, last_modified in rows}
+
+
+def save_validators(
+    conn: sqlite3.Connection,
+    cache: Dict[str, Tuple[Optional[str], Optional[str]]],
+    previous: Dict[str, Tuple[Optional[str], Optional[str]]],
+):
+    """
+    Writes only the validators that differ from `previous`, so a run where
+    nothing changed leaves the db file byte-for-byte identical.
+    """
+    conn.executemany(
+        "INSERT OR REPLACE INTO validators VALUES (?, ?, ?)",
+        [
+            (url, etag, last_modified)
+            for url, (etag, last_modified) in cache.items()
+            if previous.get(url) != (etag, last_modified)
+        ],
+    )
+    conn.executemany(
+        "DELETE FROM validators WHERE url = ?",
+        [(url,) for url in previous if url not in cache],
+    )
+
+
+def sent_links(conn: sqlite3.Connection, links: Set[str]) -> Set[str]:
+    """Returns the subset of links already recorded in the sent table."""
+    if not links:
         return set()
+    placeholders = ", ".join("?" * len(links))
+    rows = conn.execute(
+        f"SELECT link FROM sent WHERE link IN ({placeholders})", tuple(links)
+    )
+    return {link for (link,) in rows}
 
 
-def save_sent_listings(urls: Set[str]):
-    with open(SENT_LISTINGS_FILE, "w") as f:
-        json.dump(list(urls), f, indent=2)
+def mark_sent(conn: sqlite3.Connection, links: Iterable[str]):
+    conn.executemany(
+        "INSERT OR IGNORE INTO sent VALUES (?)", ((link,) for link in links)
+    )
 
 
-def send_discord_notification(prop: Property, webhook_url: str):
+def _build_embed(prop: Property) -> Dict:
     embed = {
         "title": prop.name,
         "url": prop.link,
@@ -258,16 +377,79 @@ def send_discord_notification(prop: Property, webhook_url: str):
             {"name": "Bedrooms", "value": str(prop.bedrooms), "inline": True},
             {"name": "Bathrooms", "value": str(prop.bathrooms), "inline": True},
         ],
-        "image": {"url": prop.image},
         "footer": {"text": f"Source: {prop.source}"},
     }
-    payload = {"embeds": [embed]}
+    # Discord rejects an embed with an empty image URL, which would fail the
+    # whole batch, so only attach the image when the listing has one.
+    if prop.image:
+        embed["image"] = {"url": prop.image}
+    return embed
+
+
+def _retry_after(response: httpx.Response) -> float:
+    # Discord puts the wait in seconds in the JSON body; fall back to the header.
     try:
-        response = requests.post(webhook_url, json=payload)
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        try:
+            return float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            return 1.0
+
+
+def send_discord_notification(
+    props: List[Property], webhook_url: str
+) -> List[Property]:
+    """
+    Posts one batch of embeds, waiting out Discord's rate limit when told to.
+    Returns the listings worth retrying next run: those hit by a rate limit,
+    a 5xx or a network error. A batch Discord rejects outright is resent one
+    embed at a time, and an embed it still rejects is logged and dropped.
+    """
+    payload = {"embeds": [_build_embed(prop) for prop in props]}
+    try:
+        response = discord_client.post(webhook_url, json=payload)
+        for _ in range(DISCORD_MAX_RETRIES):
+            if response.status_code != 429:
+                break
+            delay = _retry_after(response)
+            if delay > DISCORD_MAX_RETRY_DELAY:
+                break
+            logging.warning(f"Rate limited by Discord; retrying in {delay:.1f}s.")
+            time.sleep(delay)
+            response = discord_client.post(webhook_url, json=payload)
         response.raise_for_status()
-        logging.info(f"Successfully sent notification for: {prop.name}")
-    except requests.RequestException as e:
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
+        if status == 429 or status >= 500:
+            logging.error(f"Failed to send Discord notification: {e}")
+            return props
+        if len(props) > 1:
+            logging.warning(
+                f"Discord rejected a batch of {len(props)} ({status}); "
+                "sending them one at a time."
+            )
+            return [
+                unsent
+                for prop in props
+                for unsent in send_discord_notification([prop], webhook_url)
+            ]
+        logging.error(
+            f"Discord rejected the notification for {props[0].name}, skipping it: {e}"
+        )
+        return []
+    except (httpx.TransportError, httpx.InvalidURL) as e:
+        # A bad webhook URL fails every batch until the secret is fixed, so
+        # keep the listings for a later run rather than dropping them.
         logging.error(f"Failed to send Discord notification: {e}")
+        return props
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to send Discord notification, skipping it: {e}")
+        return []
+
+    for prop in props:
+        logging.info(f"Successfully sent notification for: {prop.name}")
+    return []
 
 
 def main():
@@ -282,27 +464,64 @@ def main():
         "onthemarket": "https://www.onthemarket.com/to-rent/property/central-guildford/?let-length=long-term&max-bedrooms=2&min-bedrooms=1&max-price=1500&radius=1.0&recently-added=24-hours&shared=false&student=false",
     }
 
-    all_listings = []
-    all_listings.extend(scrape_rightmove(urls["rightmove"]))
-    all_listings.extend(scrape_zoopla(urls["zoopla"]))
-    all_listings.extend(scrape_onthemarket(urls["onthemarket"]))
-
-    if not all_listings:
-        logging.info("No new listings found across all sites in this run.")
-        save_sent_listings(set())
-        return
-
-    sent_urls = load_sent_listings()
-    current_urls = {p.link for p in all_listings}
-    new_listings = [p for p in all_listings if p.link not in sent_urls]
-
-    logging.info(f"Found {len(all_listings)} total listings.")
-    logging.info(f"Found {len(new_listings)} new listings to notify.")
-
-    for prop in new_listings:
-        send_discord_notification(prop, webhook_url)
+    conn = open_state_db()
+    try:
+        previous_validators = load_validators(conn)
+        validators.update(previous_validators)
+
+        # The three sites are independent, so fetch them concurrently; wall
+        # time is then roughly the slowest site rather than the sum of all three.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(scrape_rightmove, urls["rightmove"]),
+                executor.submit(scrape_zoopla, urls["zoopla"]),
+                executor.submit(scrape_onthemarket, urls["onthemarket"]),
+            ]
+            all_listings = []
+            for future in futures:
+                all_listings.extend(future.result())
+
+        # A site can return the same link more than once; notify it once,
+        # keeping the first occurrence.
+        current_urls = {p.link for p in all_listings}
+        new_urls = current_urls - sent_links(conn, current_urls)
+        new_listings = []
+        for prop in all_listings:
+            if prop.link in new_urls:
+                new_urls.discard(prop.link)
+                new_listings.append(prop)
+
+        if all_listings:
+            logging.info(f"Found {len(all_listings)} total listings.")
+            logging.info(f"Found {len(new_listings)} new listings to notify.")
+        else:
+            logging.info("No new listings found across all sites in this run.")
+
+        # Discord accepts up to DISCORD_MAX_EMBEDS embeds per webhook call.
+        # Batches go out one at a time because Discord rate-limits each
+        # webhook; listings that hit a retryable failure wait for the next run.
+        unsent = set()
+        for i in range(0, len(new_listings), DISCORD_MAX_EMBEDS):
+            batch = new_listings[i : i + DISCORD_MAX_EMBEDS]
+            unsent.update(
+                p.link for p in send_discord_notification(batch, webhook_url)
+            )
 
-    save_sent_listings(current_urls)
+        # Record the run in one transaction, and only once the notifications
+        # are out: if the run dies first, the next one refetches the pages
+        # instead of getting a 304 and never notifying these listings.
+        with conn:
+            mark_sent(conn, current_urls - unsent)
+            # Keeping the old validators makes the next run refetch the pages
+            # that still hold unsent listings instead of getting a 304.
+            if unsent:
+                logging.warning(
+                    f"{len(unsent)} listings were not sent; retrying next run."
+                )
+            else:
+                save_validators(conn, validators, previous_validators)
+    finally:
+        conn.close()
     logging.info("Finished run.")
 
 